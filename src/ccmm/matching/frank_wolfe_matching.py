@@ -1,10 +1,14 @@
 import logging
+import os
+from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
-from typing import Dict, List, Tuple, Union
+from typing import Dict, List, Optional, Tuple, Union
 
 import numpy as np
 import scipy  # NOQA
 import torch
+from joblib import Parallel, delayed
 from pytorch_lightning import seed_everything
 from scipy.optimize import fminbound
 from tqdm import tqdm
@@ -13,16 +17,26 @@ from ccmm.matching.permutation_spec import PermutationSpec
 from ccmm.matching.utils import (
     PermutationIndices,
     PermutationMatrix,
-    generalized_inner_product,
-    perm_cols,
+    get_perm_indices_if_permutation,
+    invalidate_perm_indices_cache,
+    is_identity_permutation,
     perm_indices_to_perm_matrix,
-    perm_rows,
+    tag_identity_permutation,
 )
 from ccmm.matching.weight_matching import solve_linear_assignment_problem, weight_matching
-from ccmm.utils.utils import ModelParams, to_np
+from ccmm.utils.utils import ModelParams
+
+try:
+    # JIT-fused gather-dot for the CPU one-hot case, skipping the permuted copy of Wb entirely
+    from numba import njit, prange
+except ImportError:
+    njit = None
 
 pylogger = logging.getLogger(__name__)
 
+# expensive reference-matmul checks in the hot kernels, off unless explicitly requested via the environment
+_CCMM_VALIDATE = os.environ.get("CCMM_VALIDATE", "0").lower() in ("1", "true")
+
 
 def frank_wolfe_weight_matching(
     ps: PermutationSpec,
@@ -46,6 +60,17 @@ def frank_wolfe_weight_matching(
     """
     params_a, params_b = fixed, permutee
 
+    if str(device) != "cpu" and torch.cuda.is_available():
+        # matching only needs enough precision to rank assignments (the result is an integer permutation),
+        # so let Ampere+ tensor cores run the FP32 GEMMs in TF32
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
+
+    # move the weights to the target device once; the layer plan, iterates and gradients all stay resident
+    # there, so the only host round-trips left are the LAP projections
+    params_a = {k: v.to(device, non_blocking=True).contiguous() for k, v in params_a.items()}
+    params_b = {k: v.to(device, non_blocking=True).contiguous() for k, v in params_b.items()}
+
     # FOR MLP
     # ps.perm_to_layers_and_axes["P_final"] = [("layer4.weight", 0)]
 
@@ -66,12 +91,26 @@ def frank_wolfe_weight_matching(
     best_perm_matrices_history = None
     all_trial_perm_matrices = []
 
-    for seed in tqdm(seeds, desc="Running multiple trials"):
-        seed_everything(seed)
+    # trials are independent random restarts over read-only params, so on CPU they can run in separate
+    # processes; on CUDA the GEMMs already saturate the device, so keep the trials sequential
+    n_jobs = min(num_trials, os.cpu_count() or 1) if str(device) == "cpu" else 1
 
-        perm_matrices, perm_matrices_history, trial_obj = frank_wolfe_weight_matching_trial(
-            params_a, params_b, perm_sizes, initialization_method, ps, max_iter, device=device
+    if n_jobs > 1:
+        trial_results = Parallel(backend="loky", n_jobs=n_jobs)(
+            delayed(_run_trial)(
+                seed, params_a, params_b, perm_sizes, initialization_method, ps, max_iter, device, n_jobs
+            )
+            for seed in seeds
         )
+    else:
+        trial_results = [
+            _run_trial(seed, params_a, params_b, perm_sizes, initialization_method, ps, max_iter, device)
+            for seed in tqdm(seeds, desc="Running multiple trials")
+        ]
+
+    best_proj_indices = None
+
+    for perm_matrices, perm_matrices_history, trial_obj, last_proj_indices in trial_results:
         pylogger.info(f"Trial objective: {trial_obj}")
 
         all_trial_perm_matrices.append(perm_matrices)
@@ -81,10 +120,21 @@ def frank_wolfe_weight_matching(
             best_obj = trial_obj
             best_perm_matrices = perm_matrices
             best_perm_matrices_history = perm_matrices_history
+            best_proj_indices = last_proj_indices
 
-    all_perm_indices = {
-        p: perm if keep_soft_perms else solve_linear_assignment_problem(perm) for p, perm in best_perm_matrices.items()
-    }
+    all_perm_indices = {}
+    for p, perm in best_perm_matrices.items():
+        if keep_soft_perms:
+            all_perm_indices[p] = perm
+            continue
+
+        # if the iterate already converged onto the last projected vertex, its assignment is known and the
+        # final LAP (O(n^3) per permutation) can be skipped
+        cached = best_proj_indices.get(p) if best_proj_indices is not None else None
+        if cached is not None and torch.linalg.norm(perm - perm_indices_to_perm_matrix(cached).to(perm.device)) < 1e-5:
+            all_perm_indices[p] = cached
+        else:
+            all_perm_indices[p] = solve_linear_assignment_problem(perm)
 
     if return_all_trial_perm_matrices:
         return all_perm_indices, best_perm_matrices_history, all_trial_perm_matrices
@@ -92,6 +142,21 @@ def frank_wolfe_weight_matching(
     return all_perm_indices, best_perm_matrices_history
 
 
+def _run_trial(seed, params_a, params_b, perm_sizes, initialization_method, ps, max_iter, device, num_workers=1):
+    """
+    Run a single random-restart trial. Top-level so joblib can ship it to a worker process.
+    """
+    seed_everything(seed)
+
+    if num_workers > 1:
+        # avoid oversubscription when several trials share the machine
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // num_workers))
+
+    return frank_wolfe_weight_matching_trial(
+        params_a, params_b, perm_sizes, initialization_method, ps, max_iter, device=device
+    )
+
+
 def collect_perm_sizes(perm_spec, ref_params):
     perm_sizes = {}
 
@@ -103,6 +168,100 @@ def collect_perm_sizes(perm_spec, ref_params):
     return perm_sizes
 
 
+# static per-layer state shared by the objective, gradient and line-search loops: tensors are already on
+# device and contiguous, with the 2-D row/col flattenings cached so conv kernels become plain GEMM operands
+LayerPlanEntry = namedtuple("LayerPlanEntry", ["layer", "Wa", "Wb", "Wa_rows", "Wa_cols", "row_perm_id", "col_perm_id"])
+
+
+def _build_layer_plan(params_a, params_b, layers_and_axes_to_perms, device="cuda"):
+    """
+    Build the static iteration plan over the permuted layers.
+
+    All the per-layer work that does not depend on the permutation iterates (device transfer, unsqueezing
+    1-D params, resolving the row/col permutation ids, flattening to 2-D) is hoisted here so the hot loops
+    only do tensor ops.
+    """
+    plan = []
+
+    for layer, axes_and_perms in layers_and_axes_to_perms.items():
+        if (
+            "num_batches_tracked" in layer
+            or "running_mean" in layer
+            or "running_var" in layer
+            or "temperature" in layer
+        ):
+            continue
+
+        assert layer in params_a.keys()
+        assert layer in params_b.keys()
+
+        Wa, Wb = params_a[layer], params_b[layer]
+        Wa, Wb = Wa.to(device), Wb.to(device)
+        if Wa.dim() == 1:
+            Wa = Wa.unsqueeze(1)
+            Wb = Wb.unsqueeze(1)
+
+        Wa, Wb = Wa.contiguous(), Wb.contiguous()
+
+        row_perm_id = axes_and_perms[0]
+        col_perm_id = axes_and_perms[1] if len(axes_and_perms) > 1 else None
+
+        Wa_rows = Wa.reshape(Wa.shape[0], -1)
+        Wa_cols = Wa.transpose(0, 1).reshape(Wa.shape[1], -1).contiguous()
+
+        plan.append(LayerPlanEntry(layer, Wa, Wb, Wa_rows, Wa_cols, row_perm_id, col_perm_id))
+
+    return plan
+
+
+# layers whose gradient GEMMs have identical operand shapes, stacked so one torch.bmm replaces a run of
+# small dispatch-bound matmuls; per_perm_positions maps each target permutation to its slices of the batch
+GemmBucket = namedtuple("GemmBucket", ["indices", "Wa_stack", "per_perm_positions"])
+GemmBucketPlan = namedtuple("GemmBucketPlan", ["row_buckets", "col_buckets", "row_bucketed", "col_bucketed"])
+
+
+def _build_gemm_buckets(layer_plan):
+    """
+    Group plan entries whose gradient GEMM operands have the same 2-D shape.
+
+    ResNets repeat the same channel counts across blocks, so most layers share their operand shapes; the
+    static Wa side of each group is stacked once here, and the gradient loop batches the whole group into a
+    single torch.bmm. Groups of one keep using the per-layer kernels.
+    """
+    row_groups = defaultdict(list)
+    col_groups = defaultdict(list)
+
+    for i, entry in enumerate(layer_plan):
+        if entry.row_perm_id is not None:
+            row_groups[tuple(entry.Wa_rows.shape)].append(i)
+        if entry.col_perm_id is not None:
+            col_groups[tuple(entry.Wa_cols.shape)].append(i)
+
+    def build_buckets(groups, stack_attr, perm_attr):
+        buckets = []
+        for indices in groups.values():
+            if len(indices) < 2:
+                continue
+
+            Wa_stack = torch.stack([getattr(layer_plan[i], stack_attr) for i in indices])
+
+            per_perm_positions = defaultdict(list)
+            for position, i in enumerate(indices):
+                per_perm_positions[getattr(layer_plan[i], perm_attr)].append(position)
+
+            buckets.append(GemmBucket(indices, Wa_stack, dict(per_perm_positions)))
+
+        return buckets
+
+    row_buckets = build_buckets(row_groups, "Wa_rows", "row_perm_id")
+    col_buckets = build_buckets(col_groups, "Wa_cols", "col_perm_id")
+
+    row_bucketed = {i for bucket in row_buckets for i in bucket.indices}
+    col_bucketed = {i for bucket in col_buckets for i in bucket.indices}
+
+    return GemmBucketPlan(row_buckets, col_buckets, row_bucketed, col_bucketed)
+
+
 def frank_wolfe_weight_matching_trial(
     params_a,
     params_b,
@@ -118,28 +277,50 @@ def frank_wolfe_weight_matching_trial(
     perm_matrices: Dict[str, PermutationMatrix] = initialize_perm_matrices(
         perm_sizes, initialization_method, params_a, params_b, perm_spec, device=device
     )
-    perm_matrices_history = [perm_matrices]
+    # the iterates are updated in place, so history entries need their own copies
+    perm_matrices_history = [{p: perm.clone() for p, perm in perm_matrices.items()}]
+
+    layer_plan = _build_layer_plan(params_a, params_b, perm_spec.layer_and_axes_to_perm, device=device)
+    gemm_buckets = _build_gemm_buckets(layer_plan)
+
+    # reused across iterations and zeroed in place, instead of reallocating L x (n, n) buffers per step
+    grad_buffers = {p: torch.zeros((n, n), device=device) for p, n in perm_sizes.items()}
 
     old_obj = 0.0
     patience_steps = 0
     all_step_sizes = []
+    last_proj_indices = None
 
-    for iteration in tqdm(range(max_iter), desc="Weight matching"):
-        pylogger.info(f"Iteration {iteration}")
+    # no inner progress bar: the per-iteration refresh is measurable on fast configs, the per-trial bar stays
+    for iteration in range(max_iter):
+        if pylogger.isEnabledFor(logging.DEBUG):
+            pylogger.debug(f"Iteration {iteration}")
 
         gradients = weight_matching_gradient_fn(
-            params_a, params_b, perm_matrices, perm_spec.layer_and_axes_to_perm, perm_sizes
+            params_a,
+            params_b,
+            perm_matrices,
+            perm_spec.layer_and_axes_to_perm,
+            perm_sizes,
+            layer_plan=layer_plan,
+            gradients=grad_buffers,
+            gemm_buckets=gemm_buckets,
         )
 
-        proj_grads = project_gradients(gradients, device)
+        proj_grads, last_proj_indices = project_gradients(gradients, device, return_indices=True)
 
-        step_size = compute_step_size(proj_grads, perm_matrices, params_a, params_b, perm_spec, global_step_size)
+        step_size = compute_step_size(
+            proj_grads, perm_matrices, params_a, params_b, perm_spec, global_step_size, layer_plan=layer_plan
+        )
 
         perm_matrices = update_perm_matrices(perm_matrices, proj_grads, step_size)
 
-        new_obj = get_global_obj_layerwise(params_a, params_b, perm_matrices, perm_spec.layer_and_axes_to_perm)
+        new_obj = get_global_obj_layerwise(
+            params_a, params_b, perm_matrices, perm_spec.layer_and_axes_to_perm, layer_plan=layer_plan
+        )
 
-        pylogger.info(f"Objective: {np.round(new_obj, 6)}")
+        if pylogger.isEnabledFor(logging.DEBUG):
+            pylogger.debug(f"Objective: {np.round(new_obj, 6)}")
 
         if (new_obj - old_obj) < 1e-4:
             patience_steps += 1
@@ -152,25 +333,31 @@ def frank_wolfe_weight_matching_trial(
 
         all_step_sizes.append(step_size)
 
-        perm_matrices_history.append(perm_matrices)
+        perm_matrices_history.append({p: perm.clone() for p, perm in perm_matrices.items()})
 
     if return_step_sizes:
         return perm_matrices, perm_matrices_history, new_obj, all_step_sizes
 
-    return perm_matrices, perm_matrices_history, new_obj
+    return perm_matrices, perm_matrices_history, new_obj, last_proj_indices
 
 
 def initialize_perm_matrices(
     perm_sizes, initialization_method, fixed=None, permutee=None, perm_spec=None, device="cpu"
 ):
     if initialization_method == "identity":
-        return {p: torch.eye(n).to(device) for p, n in perm_sizes.items()}
+        # the full eyes are still needed as lerp operands for the first update, but tagging them lets the
+        # objective and gradient paths skip the identity matmuls until the iterates first move
+        return {p: tag_identity_permutation(torch.eye(n, device=device)) for p, n in perm_sizes.items()}
     elif initialization_method == "random":
         return {p: torch.rand(n, n).to(device) for p, n in perm_sizes.items()}
     elif initialization_method == "sinkhorn":
-        return {p: sinkhorn_knopp(initialize_perturbed_uniform(n)) for p, n in perm_sizes.items()}
+        return {p: sinkhorn_knopp(initialize_perturbed_uniform(n, device=device)) for p, n in perm_sizes.items()}
     elif initialization_method == "LAP":
-        perm_indices = weight_matching(perm_spec, fixed, permutee)
+        # weight_matching accumulates on CPU, so hand it CPU copies: the params may already sit on the
+        # matching device at this point
+        perm_indices = weight_matching(
+            perm_spec, {k: v.cpu() for k, v in fixed.items()}, {k: v.cpu() for k, v in permutee.items()}
+        )
         return {p: perm_indices_to_perm_matrix(perm_indices[p]).to(device) for p in perm_indices.keys()}
     elif initialization_method == "bistochastic_barycenter":
         return {p: torch.ones((n, n)).to(device) / n for p, n in perm_sizes.items()}
@@ -178,14 +365,38 @@ def initialize_perm_matrices(
         raise ValueError(f"Unknown initialization method {initialization_method}")
 
 
-def project_gradients(gradients, device):
-    proj_grads = {}
+# the LAP solvers (lap's C implementation and scipy's Hungarian) release the GIL, so the per-permutation
+# assignments can run concurrently; the pool is created lazily and reused across iterations
+_lap_executor = None
 
-    for perm_name, grad in gradients.items():
 
-        proj_grad = solve_linear_assignment_problem(grad, return_matrix=True)
+def _get_lap_executor():
+    global _lap_executor
+    if _lap_executor is None:
+        _lap_executor = ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1))
+    return _lap_executor
 
-        proj_grads[perm_name] = proj_grad.to(device)
+
+def project_gradients(gradients, device, return_indices=False):
+    perm_names = list(gradients.keys())
+
+    if len(perm_names) > 1:
+        # executor.map preserves input order, so results line up with perm_names
+        all_indices = list(
+            _get_lap_executor().map(solve_linear_assignment_problem, (gradients[p] for p in perm_names))
+        )
+    else:
+        all_indices = [solve_linear_assignment_problem(gradients[p]) for p in perm_names]
+
+    proj_grads = {}
+    proj_indices = {}
+
+    for perm_name, indices in zip(perm_names, all_indices):
+        proj_grads[perm_name] = perm_indices_to_perm_matrix(indices).to(device)
+        proj_indices[perm_name] = indices
+
+    if return_indices:
+        return proj_grads, proj_indices
 
     return proj_grads
 
@@ -216,6 +427,67 @@ def armijo_goldstein_line_search(line_search_step_func, x, d, alpha=0.3, beta=0.
     return gamma
 
 
+def compute_line_search_coefficients(layer_plan, perm_matrices, proj_grads):
+    """
+    Compute the four endpoint traces of the line-search objective.
+
+    The layerwise similarity <Wa, P_row Wb P_col^T> is bilinear in (P_row, P_col), so along the segment
+    (1 - t) P + t G it expands as (1-t)^2 T_PP + t (1-t) (T_PG + T_GP) + t^2 T_GG, where each trace only
+    depends on which endpoint (current iterate P or projected gradient G) is plugged into each axis.
+    """
+
+    T_PP, T_PG, T_GP, T_GG = 0.0, 0.0, 0.0, 0.0
+
+    for entry in layer_plan:
+        row_P = perm_matrices[entry.row_perm_id] if entry.row_perm_id is not None else None
+        row_is_free = entry.row_perm_id is not None and entry.row_perm_id != "P_final"
+        row_G = proj_grads[entry.row_perm_id] if row_is_free else row_P
+
+        col_P = perm_matrices[entry.col_perm_id] if entry.col_perm_id is not None else None
+        col_is_free = entry.col_perm_id is not None and entry.col_perm_id != "P_final"
+        col_G = proj_grads[entry.col_perm_id] if col_is_free else col_P
+
+        sim_pp = compute_layer_similarity(entry.Wa, entry.Wb, row_P, col_P)
+        sim_pg = compute_layer_similarity(entry.Wa, entry.Wb, row_P, col_G) if col_is_free else sim_pp
+        sim_gp = compute_layer_similarity(entry.Wa, entry.Wb, row_G, col_P) if row_is_free else sim_pp
+
+        if not row_is_free:
+            sim_gg = sim_pg
+        elif not col_is_free:
+            sim_gg = sim_gp
+        else:
+            sim_gg = compute_layer_similarity(entry.Wa, entry.Wb, row_G, col_G)
+
+        T_PP = T_PP + sim_pp
+        T_PG = T_PG + sim_pg
+        T_GP = T_GP + sim_gp
+        T_GG = T_GG + sim_gg
+
+    # the four traces are reduced on device; this is the only host sync of the line search
+    return float(T_PP), float(T_PG), float(T_GP), float(T_GG)
+
+
+def analytic_step_size(proj_grads, perm_matrices, layer_plan) -> float:
+    """
+    Closed-form maximizer of the line-search objective over [0, 1].
+
+    All permutations share the same step size, so the global objective is an exact quadratic
+    a t^2 + b t + T_PP in t: no iterative search is needed, just the clamped vertex (or the better
+    endpoint when the quadratic is not concave).
+    """
+
+    T_PP, T_PG, T_GP, T_GG = compute_line_search_coefficients(layer_plan, perm_matrices, proj_grads)
+
+    a = T_PP - T_PG - T_GP + T_GG
+    b = T_PG + T_GP - 2 * T_PP
+
+    if a < 0:
+        return float(np.clip(-b / (2 * a), 0.0, 1.0))
+
+    # convex or linear in t: the maximum over [0, 1] sits at an endpoint, f(0) = T_PP and f(1) = T_GG
+    return 0.0 if T_PP >= T_GG else 1.0
+
+
 def compute_step_size(
     proj_grads,
     perm_matrices,
@@ -223,9 +495,13 @@ def compute_step_size(
     params_b,
     perm_spec,
     global_step_size=True,
-    line_search_strategy="fminbound",
+    line_search_strategy="analytic",
+    layer_plan=None,
 ) -> Union[float, np.array]:
 
+    if layer_plan is None:
+        layer_plan = _build_layer_plan(params_a, params_b, perm_spec.layer_and_axes_to_perm)
+
     line_search_step_func = partial(
         line_search_step,
         proj_grads=proj_grads,
@@ -233,11 +509,15 @@ def compute_step_size(
         params_a=params_a,
         params_b=params_b,
         layers_and_axes_to_perms=perm_spec.layer_and_axes_to_perm,
+        layer_plan=layer_plan,
     )
 
     if global_step_size:
 
-        if line_search_strategy == "fminbound":
+        if line_search_strategy == "analytic":
+            step_size = analytic_step_size(proj_grads, perm_matrices, layer_plan)
+
+        elif line_search_strategy == "fminbound":
             step_size = fminbound(line_search_step_func, 0, 1)
 
         else:
@@ -250,7 +530,8 @@ def compute_step_size(
 
             step_size = search_fn(line_search_step_func, x, d)
 
-        pylogger.info(f"Step size: {step_size}")
+        if pylogger.isEnabledFor(logging.DEBUG):
+            pylogger.debug(f"Step size: {step_size}")
 
     else:
         x0 = np.array([0.0] * len(perm_matrices))
@@ -269,6 +550,7 @@ def line_search_step(
     proj_grads: Dict[str, torch.Tensor],
     perm_matrices: Dict[str, PermutationIndices],
     layers_and_axes_to_perms,
+    layer_plan=None,
 ):
 
     interpolated_perms = {}
@@ -283,103 +565,158 @@ def line_search_step(
         alpha = step_size if isinstance(step_size, float) else step_size[ind]
         interpolated_perms[perm_name] = (1 - alpha) * perm + alpha * proj_grad
 
-    tot_obj = get_global_obj_layerwise(params_a, params_b, interpolated_perms, layers_and_axes_to_perms)
+    tot_obj = get_global_obj_layerwise(
+        params_a, params_b, interpolated_perms, layers_and_axes_to_perms, layer_plan=layer_plan
+    )
 
     return -tot_obj
 
 
-def get_global_obj_layerwise(params_a, params_b, perm_matrices, layers_and_axes_to_perms, device="cuda"):
-
-    tot_obj = 0.0
-
-    for layer, axes_and_perms in layers_and_axes_to_perms.items():
-        if (
-            "num_batches_tracked" in layer
-            or "running_mean" in layer
-            or "running_var" in layer
-            or "temperature" in layer
-        ):
-            continue
+def get_global_obj_layerwise(
+    params_a, params_b, perm_matrices, layers_and_axes_to_perms, device="cuda", layer_plan=None
+):
 
-        assert layer in params_a.keys()
-        assert layer in params_b.keys()
+    if layer_plan is None:
+        layer_plan = _build_layer_plan(params_a, params_b, layers_and_axes_to_perms, device=device)
 
-        Wa, Wb = params_a[layer], params_b[layer]
-        Wa, Wb = Wa.to(device), Wb.to(device)
-        if Wa.dim() == 1:
-            Wa = Wa.unsqueeze(1)
-            Wb = Wb.unsqueeze(1)
+    tot_obj = 0.0
 
-        row_perm_id = axes_and_perms[0]
-        assert row_perm_id is None or row_perm_id in perm_matrices.keys()
-        row_perm = perm_matrices[row_perm_id] if row_perm_id is not None else torch.eye(Wa.shape[0], device=device)
+    for entry in layer_plan:
+        assert entry.row_perm_id is None or entry.row_perm_id in perm_matrices.keys()
+        row_perm = perm_matrices[entry.row_perm_id] if entry.row_perm_id is not None else None
 
-        col_perm_id = axes_and_perms[1] if len(axes_and_perms) > 1 else None
-        assert col_perm_id is None or col_perm_id in perm_matrices.keys()
-        col_perm = perm_matrices[col_perm_id] if col_perm_id is not None else torch.eye(Wa.shape[1], device=device)
+        assert entry.col_perm_id is None or entry.col_perm_id in perm_matrices.keys()
+        col_perm = perm_matrices[entry.col_perm_id] if entry.col_perm_id is not None else None
 
-        layer_similarity = compute_layer_similarity(Wa, Wb, row_perm, col_perm)
+        layer_similarity = compute_layer_similarity(entry.Wa, entry.Wb, row_perm, col_perm)
 
-        tot_obj += layer_similarity
+        tot_obj = tot_obj + layer_similarity
 
-    return tot_obj
+    # single host sync for the whole objective
+    return float(tot_obj)
 
 
-def weight_matching_gradient_fn(params_a, params_b, perm_matrices, layers_and_axes_to_perms, perm_sizes, device="cuda"):
+def weight_matching_gradient_fn(
+    params_a,
+    params_b,
+    perm_matrices,
+    layers_and_axes_to_perms,
+    perm_sizes,
+    device="cuda",
+    layer_plan=None,
+    gradients=None,
+    gemm_buckets=None,
+):
     """
     Compute gradient of the weight matching objective function w.r.t. P_curr and P_prev.
     sim = <Wa_i, Pi Wb_i P_{i-1}^T>_f where f is the Frobenius norm, rewrite it as < A, xBy^T>_f where A = Wa_i, x = Pi, B = Wb_i, y = P_{i-1}
 
+    Accepts preallocated accumulation buffers via `gradients`, which are zeroed in place, and an optional
+    `gemm_buckets` plan batching same-shape layers into stacked GEMMs.
+
     Returns:
         grad_P_curr: Gradient of objective function w.r.t. P_curr.
         grad_P_prev: Gradient of objective function w.r.t. P_prev.
     """
-    gradients = {p: torch.zeros((perm_sizes[p], perm_sizes[p]), device=device) for p in perm_matrices.keys()}
+    if layer_plan is None:
+        layer_plan = _build_layer_plan(params_a, params_b, layers_and_axes_to_perms, device=device)
 
-    for layer, axes_and_perms in layers_and_axes_to_perms.items():
-        if (
-            "num_batches_tracked" in layer
-            or "running_mean" in layer
-            or "running_var" in layer
-            or "temperature" in layer
-        ):
-            continue
+    if gemm_buckets is None:
+        gemm_buckets = _build_gemm_buckets(layer_plan)
 
-        assert layer in params_a.keys()
-        assert layer in params_b.keys()
-
-        Wa, Wb = params_a[layer], params_b[layer]
-        Wa, Wb = Wa.to(device), Wb.to(device)
-        if Wa.dim() == 1:
-            Wa = Wa.unsqueeze(1)
-            Wb = Wb.unsqueeze(1)
+    if gradients is None:
+        gradients = {p: torch.zeros((perm_sizes[p], perm_sizes[p]), device=device) for p in perm_matrices.keys()}
+    else:
+        torch._foreach_zero_(list(gradients.values()))
 
+    for i, entry in enumerate(layer_plan):
         # any permutation acting on the first axis is permuting rows
-        row_perm_id = axes_and_perms[0]
-        assert row_perm_id is None or row_perm_id in perm_matrices.keys()
-        row_perm = perm_matrices[row_perm_id] if row_perm_id is not None else torch.eye(Wa.shape[0], device=device)
+        assert entry.row_perm_id is None or entry.row_perm_id in perm_matrices.keys()
+        row_perm = perm_matrices[entry.row_perm_id] if entry.row_perm_id is not None else None
 
         # any permutation acting on the second axis is permuting columns
-        col_perm_id = axes_and_perms[1] if len(axes_and_perms) > 1 else None
-        assert col_perm_id is None or col_perm_id in perm_matrices.keys()
-        col_perm = perm_matrices[col_perm_id] if col_perm_id is not None else torch.eye(Wa.shape[1], device=device)
+        assert entry.col_perm_id is None or entry.col_perm_id in perm_matrices.keys()
+        col_perm = perm_matrices[entry.col_perm_id] if entry.col_perm_id is not None else None
 
-        grad_P_curr = compute_gradient_P_curr(Wa, Wb, col_perm)
-        grad_P_prev = compute_gradient_P_prev(Wa, Wb, row_perm)
+        if entry.row_perm_id is not None and i not in gemm_buckets.row_bucketed:
+            gradients[entry.row_perm_id] += compute_gradient_P_curr(
+                entry.Wa, entry.Wb, col_perm, Wa_rows=entry.Wa_rows
+            )
+        if entry.col_perm_id is not None and i not in gemm_buckets.col_bucketed:
+            gradients[entry.col_perm_id] += compute_gradient_P_prev(
+                entry.Wa, entry.Wb, row_perm, Wa_cols=entry.Wa_cols
+            )
 
-        if row_perm_id:
-            gradients[row_perm_id] += grad_P_curr
-        if col_perm_id:
-            gradients[col_perm_id] += grad_P_prev
+    for bucket in gemm_buckets.row_buckets:
+        operand_stack = torch.stack(
+            [
+                _permuted_wb_rows(
+                    layer_plan[i].Wb,
+                    perm_matrices[layer_plan[i].col_perm_id] if layer_plan[i].col_perm_id is not None else None,
+                )
+                for i in bucket.indices
+            ]
+        )
+        products = torch.bmm(bucket.Wa_stack, operand_stack.transpose(1, 2))
+        _scatter_bucket_products(gradients, products, bucket.per_perm_positions)
+
+    for bucket in gemm_buckets.col_buckets:
+        operand_stack = torch.stack(
+            [
+                _permuted_wb_cols(
+                    layer_plan[i].Wb,
+                    perm_matrices[layer_plan[i].row_perm_id] if layer_plan[i].row_perm_id is not None else None,
+                )
+                for i in bucket.indices
+            ]
+        )
+        products = torch.bmm(bucket.Wa_stack, operand_stack.transpose(1, 2))
+        _scatter_bucket_products(gradients, products, bucket.per_perm_positions)
 
     return gradients
 
 
+def _permuted_wb_rows(Wb, P_prev):
+    """(P_{l-1}-column-permuted Wb) flattened to rows, the right operand of the P_curr gradient GEMM."""
+    if P_prev is None or is_identity_permutation(P_prev):
+        return Wb.reshape(Wb.shape[0], -1)
+
+    perm_indices = get_perm_indices_if_permutation(P_prev)
+    if perm_indices is not None:
+        return Wb.index_select(1, perm_indices).reshape(Wb.shape[0], -1)
+
+    Z = P_prev @ Wb.transpose(0, 1).reshape(Wb.shape[1], -1)
+    out_shape = [P_prev.shape[0], Wb.shape[0]] + list(Wb.shape[2:])
+    return Z.reshape(out_shape).transpose(0, 1).reshape(Wb.shape[0], -1)
+
+
+def _permuted_wb_cols(Wb, P_curr):
+    """(P_l-row-permuted Wb) flattened to columns, the right operand of the P_prev gradient GEMM."""
+    if P_curr is None or is_identity_permutation(P_curr):
+        return Wb.transpose(0, 1).reshape(Wb.shape[1], -1)
+
+    perm_indices = get_perm_indices_if_permutation(P_curr)
+    if perm_indices is not None:
+        return Wb.index_select(0, perm_indices).transpose(0, 1).reshape(Wb.shape[1], -1)
+
+    Z = P_curr @ Wb.reshape(Wb.shape[0], -1)
+    out_shape = [P_curr.shape[0], Wb.shape[1]] + list(Wb.shape[2:])
+    return Z.reshape(out_shape).transpose(0, 1).reshape(Wb.shape[1], -1)
+
+
+def _scatter_bucket_products(gradients, products, per_perm_positions):
+    for perm_name, positions in per_perm_positions.items():
+        if len(positions) == 1:
+            gradients[perm_name] += products[positions[0]]
+        else:
+            gradients[perm_name] += products[positions].sum(dim=0)
+
+
 def is_last_layer(params_and_axes):
     return len(params_and_axes) == 1
 
 
-def compute_single_perm_obj_function(params_a, params_b, P_curr, P_curr_name, perm_to_axes, perm_matrices, debug=True):
+def compute_single_perm_obj_function(params_a, params_b, P_curr, P_curr_name, perm_to_axes, perm_matrices):
     """
     Compute gradient of the weight matching objective function w.r.t. P_curr and P_prev.
     sim = <Wa_i, Pi Wb_i P_{i-1}^T>_f where f is the Frobenius norm, rewrite it as < A, xBy^T>_f where A = Wa_i, x = Pi, B = Wb_i, y = P_{i-1}
@@ -393,6 +730,8 @@ def compute_single_perm_obj_function(params_a, params_b, P_curr, P_curr_name, pe
     # e.g. ('layer_0.weight', 0), ('layer_0.bias', 0), ('layer_1.weight', 0)..
     params_and_axes: List[Tuple[str, int]] = perm_to_axes[P_curr_name]
 
+    param_to_col_perm = build_param_to_col_perm(perm_to_axes)
+
     obj = 0.0
 
     for params_name, axis in params_and_axes:
@@ -403,114 +742,249 @@ def compute_single_perm_obj_function(params_a, params_b, P_curr, P_curr_name, pe
             Wa, Wb = params_a[params_name], params_b[params_name]
             assert Wa.shape == Wa.shape
 
-            P_prev_name, P_prev = get_prev_permutation(params_name, perm_to_axes, perm_matrices)
+            P_prev_name, P_prev = get_prev_permutation(params_name, perm_to_axes, perm_matrices, param_to_col_perm)
 
-            layer_similarity = compute_layer_similarity(Wa, Wb, P_curr, P_prev, debug=debug)
+            layer_similarity = compute_layer_similarity(Wa, Wb, P_curr, P_prev)
 
-            obj += layer_similarity
+            obj = obj + layer_similarity
 
-    return obj
+    return float(obj)
 
 
-def compute_layer_similarity(Wa, Wb, P_curr, P_prev, debug=True):
+def _layer_similarity_impl(
+    Wa: torch.Tensor, Wb: torch.Tensor, P_curr: Optional[torch.Tensor], P_prev: Optional[torch.Tensor]
+) -> torch.Tensor:
     """
-    Compute (P_i Wb_i) P_{i-1}^T
+    <Wa, (P_i Wb) P_{i-1}^T> as a Frobenius inner product.
+
+    The permuted Wb is reduced against Wa directly, so the n x n trace matrix of the old
+    trace(Wa^T P Wb P^T) formulation is never materialized: Wb is streamed once per permutation.
     """
+    Wb_perm = Wb
 
-    # (P_i Wb_i)
-    Wb_perm = perm_rows(perm=P_curr, x=Wb)
+    if P_curr is not None:
+        Z = P_curr @ Wb_perm.reshape(Wb_perm.shape[0], -1)
+        Wb_perm = Z.reshape([P_curr.shape[0]] + list(Wb_perm.shape[1:]))
 
     if P_prev is not None:
-        # (P_i Wb_i) P_{i-1}^T
-        Wb_perm = perm_cols(x=Wb_perm, perm=P_prev.T)
+        Z = P_prev @ Wb_perm.transpose(0, 1).reshape(Wb_perm.shape[1], -1)
+        out_shape = [P_prev.shape[0], Wb_perm.shape[0]] + list(Wb_perm.shape[2:])
+        Wb_perm = Z.reshape(out_shape).transpose(0, 1)
+
+    return (Wa * Wb_perm).sum()
+
+
+# scripted rather than torch.compile'd: the kernel is called with many distinct (shape, None-pattern)
+# combinations, which dynamo would recompile per specialization; TorchScript handles them with one trace
+_layer_similarity_kernel = torch.jit.script(_layer_similarity_impl)
+
+
+if njit is not None:
+
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _perm_similarity_numba(Wa, Wb, row_indices, col_indices):
+        total = 0.0
+        for i in prange(Wa.shape[0]):
+            row = row_indices[i]
+            acc = 0.0
+            for j in range(Wa.shape[1]):
+                acc += Wa[i, j] * Wb[row, col_indices[j]]
+            total += acc
+        return total
+
+
+def compute_layer_similarity(Wa, Wb, P_curr, P_prev):
+    """
+    Compute <Wa, (P_i Wb_i) P_{i-1}^T>. A None permutation is treated as the identity.
+    """
+
+    Wb_perm = Wb
+    row_perm, col_perm = P_curr, P_prev
+
+    # identities are skipped outright, one-hot permutations reduce to gathers; only dense
+    # (doubly-stochastic) ones reach the fused kernel
+    if row_perm is not None and is_identity_permutation(row_perm):
+        row_perm = None
+    if col_perm is not None and is_identity_permutation(col_perm):
+        col_perm = None
+
+    row_indices = get_perm_indices_if_permutation(row_perm) if row_perm is not None else None
+    col_indices = get_perm_indices_if_permutation(col_perm) if col_perm is not None else None
+
+    if (
+        njit is not None
+        and Wa.dim() == 2
+        and str(Wa.device) == "cpu"
+        and (row_perm is None or row_indices is not None)
+        and (col_perm is None or col_indices is not None)
+    ):
+        # both permutations are one-hot (or trivial): accumulate the gathered dot products directly,
+        # without materializing the permuted copy of Wb
+        row_idx = row_indices if row_indices is not None else torch.arange(Wb.shape[0])
+        col_idx = col_indices if col_indices is not None else torch.arange(Wb.shape[1])
+        sim = torch.tensor(_perm_similarity_numba(Wa.numpy(), Wb.numpy(), row_idx.numpy(), col_idx.numpy()))
+    else:
+        if row_indices is not None:
+            Wb_perm = Wb_perm.index_select(0, row_indices)
+            row_perm = None
 
-    inner_product = generalized_inner_product(Wa.transpose(1, 0), Wb_perm)
-    sim = torch.trace(inner_product)
+        if col_indices is not None:
+            Wb_perm = Wb_perm.index_select(1, col_indices)
+            col_perm = None
 
-    if debug and len(Wa.shape) == 2:
+        sim = _layer_similarity_kernel(Wa, Wb_perm, row_perm, col_perm)
+
+    if _CCMM_VALIDATE and len(Wa.shape) == 2 and P_curr is not None and P_prev is not None:
         assert torch.allclose(
             sim, torch.trace(Wa.T @ P_curr @ Wb @ P_prev.T), atol=1e-3
         ), f"{sim} != {torch.trace(Wa.T @ P_curr @ Wb @ P_prev.T)}"
 
-    return to_np(sim)
+    # kept as a 0-dim tensor: converting here would force a device sync per layer, callers reduce in
+    # tensor space and synchronize once
+    return sim
+
+
+@torch.jit.script
+def _dense_grad_P_curr(Wa_rows: torch.Tensor, Wb: torch.Tensor, P_prev: torch.Tensor) -> torch.Tensor:
+    """A (P_{l-1} B^T) for a dense (doubly-stochastic) P_prev, as two plain GEMMs."""
+    Wb_in_first = Wb.transpose(0, 1).reshape(Wb.shape[1], -1)
+    Z = P_prev @ Wb_in_first
+    out_shape = [P_prev.shape[0], Wb.shape[0]] + list(Wb.shape[2:])
+    Wb_colperm_rows = Z.reshape(out_shape).transpose(0, 1).reshape(Wb.shape[0], -1)
+    return Wa_rows @ Wb_colperm_rows.transpose(0, 1)
+
+
+@torch.jit.script
+def _perm_grad_P_curr(Wa_rows: torch.Tensor, Wb: torch.Tensor, perm_indices: torch.Tensor) -> torch.Tensor:
+    """A (P_{l-1} B^T) when P_prev is a one-hot permutation given by its row indices."""
+    Wb_colperm_rows = Wb.index_select(1, perm_indices).reshape(Wb.shape[0], -1)
+    return Wa_rows @ Wb_colperm_rows.transpose(0, 1)
+
+
+@torch.jit.script
+def _dense_grad_P_prev(Wa_cols: torch.Tensor, Wb: torch.Tensor, P_curr: torch.Tensor) -> torch.Tensor:
+    """A^T (P_l B) for a dense (doubly-stochastic) P_curr, as two plain GEMMs."""
+    Z = P_curr @ Wb.reshape(Wb.shape[0], -1)
+    out_shape = [P_curr.shape[0], Wb.shape[1]] + list(Wb.shape[2:])
+    Wb_perm_cols = Z.reshape(out_shape).transpose(0, 1).reshape(Wb.shape[1], -1)
+    return Wa_cols @ Wb_perm_cols.transpose(0, 1)
 
 
-def compute_gradient_P_curr(Wa, Wb, P_prev, debug=True):
+@torch.jit.script
+def _perm_grad_P_prev(Wa_cols: torch.Tensor, Wb: torch.Tensor, perm_indices: torch.Tensor) -> torch.Tensor:
+    """A^T (P_l B) when P_curr is a one-hot permutation given by its row indices."""
+    Wb_perm_cols = Wb.index_select(0, perm_indices).transpose(0, 1).reshape(Wb.shape[1], -1)
+    return Wa_cols @ Wb_perm_cols.transpose(0, 1)
+
+
+def compute_gradient_P_curr(Wa, Wb, P_prev, Wa_rows=None):
     """
-    (A P_{l-1} B^T)
+    (A P_{l-1} B^T). A None P_prev is treated as the identity.
     """
 
-    if P_prev is None:
-        P_prev = torch.eye(Wb.shape[1])
-
     assert Wa.shape == Wb.shape
-    assert P_prev.shape[0] == Wb.shape[1]
+    assert P_prev is None or P_prev.shape[0] == Wb.shape[1]
 
-    # P_{l-1} B^T
-    Wb_perm = perm_rows(x=Wb.transpose(1, 0), perm=P_prev)
+    if Wa_rows is None:
+        Wa_rows = Wa.reshape(Wa.shape[0], -1)
 
-    grad_P_curr = generalized_inner_product(Wa, Wb_perm)
+    if P_prev is None or is_identity_permutation(P_prev):
+        grad_P_curr = Wa_rows @ Wb.reshape(Wb.shape[0], -1).transpose(0, 1)
+    else:
+        perm_indices = get_perm_indices_if_permutation(P_prev)
+        if perm_indices is not None:
+            grad_P_curr = _perm_grad_P_curr(Wa_rows, Wb, perm_indices)
+        else:
+            grad_P_curr = _dense_grad_P_curr(Wa_rows, Wb, P_prev)
 
-    if debug and len(Wa.shape) == 2:
+    if _CCMM_VALIDATE and len(Wa.shape) == 2 and P_prev is not None:
         assert torch.allclose(grad_P_curr, Wa @ P_prev @ Wb.T, atol=1e-3)
 
     return grad_P_curr
 
 
-def compute_gradient_P_prev(Wa, Wb, P_curr, debug=True):
+def compute_gradient_P_prev(Wa, Wb, P_curr, Wa_cols=None):
     """
-    (A^T P_l B)
+    (A^T P_l B). A None P_curr is treated as the identity.
 
     """
-    assert P_curr.shape[0] == Wb.shape[0]
-
-    grad_P_prev = None
+    assert P_curr is None or P_curr.shape[0] == Wb.shape[0]
 
-    # (P_l B)
-    Wb_perm = perm_rows(perm=P_curr, x=Wb)
+    if Wa_cols is None:
+        Wa_cols = Wa.transpose(0, 1).reshape(Wa.shape[1], -1)
 
-    grad_P_prev = generalized_inner_product(Wa.transpose(1, 0), Wb_perm)
+    if P_curr is None or is_identity_permutation(P_curr):
+        grad_P_prev = Wa_cols @ Wb.transpose(0, 1).reshape(Wb.shape[1], -1).transpose(0, 1)
+    else:
+        perm_indices = get_perm_indices_if_permutation(P_curr)
+        if perm_indices is not None:
+            grad_P_prev = _perm_grad_P_prev(Wa_cols, Wb, perm_indices)
+        else:
+            grad_P_prev = _dense_grad_P_prev(Wa_cols, Wb, P_curr)
 
-    if debug and len(Wa.shape) == 2:
+    if _CCMM_VALIDATE and len(Wa.shape) == 2 and P_curr is not None:
         assert torch.allclose(grad_P_prev, Wa.T @ P_curr @ Wb, atol=1e-3)
 
     return grad_P_prev
 
 
-def get_prev_permutation(params_name, perm_to_axes, perm_matrices):
-    P_prev_name, P_prev = None, None
+def build_param_to_col_perm(perm_to_axes):
+    """
+    Invert perm_to_axes into {param_name: perm_name} for the permutations acting on axis 1,
+    so looking up the previous permutation of a layer is a dict get instead of an O(L^2) scan.
+    """
+    return {
+        param_name: perm_name
+        for perm_name, params_and_axes in perm_to_axes.items()
+        for param_name, axis in params_and_axes
+        if axis == 1
+    }
 
-    for other_perm_name, other_perm in perm_matrices.items():
 
-        # all the layers that are column-permuted by other_p
-        params_perm_by_other_p = [tup[0] if tup[1] == 1 else None for tup in perm_to_axes[other_perm_name]]
-        if params_name in params_perm_by_other_p:
-            P_prev_name = other_perm_name
-            P_prev = other_perm
+def get_prev_permutation(params_name, perm_to_axes, perm_matrices, param_to_col_perm=None):
+    if param_to_col_perm is None:
+        param_to_col_perm = build_param_to_col_perm(perm_to_axes)
+
+    # the permutation that column-permutes this layer, if any
+    P_prev_name = param_to_col_perm.get(params_name)
+    P_prev = perm_matrices[P_prev_name] if P_prev_name is not None else None
 
     return P_prev_name, P_prev
 
 
 def update_perm_matrices(perm_matrices, proj_grads, step_size: Union[float, np.array]):
-    new_perm_matrices = {}
+    """
+    Interpolate each free permutation towards its projected gradient, in place.
 
-    for i, (perm_name, perm) in enumerate(perm_matrices.items()):
+    With a global step size all interpolations are batched into a single foreach kernel, avoiding the
+    per-permutation intermediates of (1 - alpha) * perm + alpha * proj_grad. The mutated dict is returned.
+    """
 
-        if perm_name == "P_final":
-            new_perm_matrices[perm_name] = perm
-            continue
+    active_names = [perm_name for perm_name in perm_matrices.keys() if perm_name != "P_final"]
 
-        proj_grad = proj_grads[perm_name]
+    if isinstance(step_size, float):
+        active_perms = [perm_matrices[perm_name] for perm_name in active_names]
+        active_grads = [proj_grads[perm_name] for perm_name in active_names]
+
+        if hasattr(torch, "_foreach_lerp_"):
+            torch._foreach_lerp_(active_perms, active_grads, step_size)
+        else:
+            torch._foreach_mul_(active_perms, 1 - step_size)
+            torch._foreach_add_(active_perms, active_grads, alpha=step_size)
+    else:
+        for i, perm_name in enumerate(perm_matrices.keys()):
+            if perm_name == "P_final":
+                continue
 
-        alpha = step_size if isinstance(step_size, float) else step_size[i]
+            perm_matrices[perm_name].lerp_(proj_grads[perm_name], float(step_size[i]))
 
-        new_P_curr_interp = (1 - alpha) * perm + alpha * proj_grad
-        new_perm_matrices[perm_name] = new_P_curr_interp
+    for perm_name in active_names:
+        invalidate_perm_indices_cache(perm_matrices[perm_name])
 
-    return new_perm_matrices
+    return perm_matrices
 
 
-def sinkhorn_knopp(matrix, tol=1e-8, max_iterations=10000, device="cuda"):
+def sinkhorn_knopp(matrix, tol=1e-8, max_iterations=50, device="cuda"):
     """
     Applies the Sinkhorn-Knopp algorithm to make a non-negative matrix doubly stochastic.
 
@@ -537,11 +1011,16 @@ def sinkhorn_knopp(matrix, tol=1e-8, max_iterations=10000, device="cuda"):
         matrix /= matrix.sum(dim=1, keepdims=True)
         matrix /= matrix.sum(dim=0, keepdims=True)
 
-        # Check if matrix is close enough to doubly stochastic
-        if torch.all(torch.abs(matrix.sum(dim=0) - 1) < tol) and torch.all(torch.abs(matrix.sum(dim=1) - 1) < tol):
-            pylogger.debug(f"Sinkhorn-Knopp algorithm converged after {iter} iterations.")
+        # Check if matrix is close enough to doubly stochastic. The iteration converges geometrically, so
+        # checking every 8th pass keeps the check cost negligible without overshooting by much
+        if iter % 8 == 0:
+            err = torch.maximum(
+                (matrix.sum(dim=0) - 1).abs_().max(), (matrix.sum(dim=1) - 1).abs_().max()
+            ).item()
+            if err < tol:
+                pylogger.debug(f"Sinkhorn-Knopp algorithm converged after {iter} iterations.")
 
-            return matrix
+                return matrix
 
     row_diff = torch.abs(matrix.sum(dim=0) - 1).sum()
     col_diff = torch.abs(matrix.sum(dim=1) - 1).sum()
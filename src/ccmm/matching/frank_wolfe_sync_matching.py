@@ -323,8 +323,9 @@ def compute_layer_similarity_sync(Wa, Wb, Pa_curr, Pb_curr, Pa_prev, Pb_prev):
     # Pa_curr (Pb_curr^T (Wb (Pa_prev Pb_prev^T)^T))
     Wb_Pa_prev_Pb_prevT_Pb_curr_Pa_curr = perm_rows(x=Wb_Pa_prev_Pb_prevT_Pb_curr, perm=Pa_curr)
 
-    inner_product = generalized_inner_product(Wa.transpose(1, 0), Wb_Pa_prev_Pb_prevT_Pb_curr_Pa_curr)
-    layer_similarity = torch.trace(inner_product)
+    # tr(Wa^T X) is the Frobenius inner product <Wa, X>: summing the Hadamard product avoids building the
+    # full trace matrix just to read its diagonal
+    layer_similarity = (Wa * Wb_Pa_prev_Pb_prevT_Pb_curr_Pa_curr).sum()
 
     return layer_similarity
 
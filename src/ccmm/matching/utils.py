@@ -142,6 +142,52 @@ def create_artificially_permuted_models(
     return artificial_models
 
 
+def get_perm_indices_if_permutation(perm: PermutationMatrix):
+    """
+    Return the row indices encoded by `perm` if it is a one-hot permutation matrix, None otherwise.
+
+    The result is cached on the tensor itself, so repeated calls on the same (unmodified) matrix are free.
+    Doubly-stochastic matrices produced during a Frank-Wolfe interpolation fail the check and are cached
+    as non-permutations, paying the O(n^2) validity check only once per tensor.
+    """
+    perm_indices = getattr(perm, "_ccmm_perm_indices", None)
+    if perm_indices is not None:
+        return perm_indices
+
+    if getattr(perm, "_ccmm_not_permutation", False):
+        return None
+
+    if is_valid_permutation_matrix(perm):
+        perm_indices = perm.argmax(dim=1)
+        perm._ccmm_perm_indices = perm_indices
+        return perm_indices
+
+    perm._ccmm_not_permutation = True
+    return None
+
+
+def tag_identity_permutation(perm: PermutationMatrix):
+    """
+    Mark `perm` as an identity matrix so the hot paths can skip the permutation entirely, and pre-cache its
+    trivial index representation. The tag is dropped by `invalidate_perm_indices_cache` on the first update.
+    """
+    perm._ccmm_is_identity = True
+    perm._ccmm_perm_indices = torch.arange(perm.shape[0], device=perm.device)
+    return perm
+
+
+def is_identity_permutation(perm: PermutationMatrix) -> bool:
+    """True if `perm` has been tagged as an (unmodified) identity matrix."""
+    return getattr(perm, "_ccmm_is_identity", False)
+
+
+def invalidate_perm_indices_cache(perm: PermutationMatrix):
+    """Drop any cached index representation, e.g. after an in-place update of `perm`."""
+    for attr in ("_ccmm_perm_indices", "_ccmm_not_permutation", "_ccmm_is_identity"):
+        if hasattr(perm, attr):
+            delattr(perm, attr)
+
+
 def perm_rows(x, perm):
     """
     X ~ (n, d0) or (n, d0, d1) or (n, d0, d1, d2)
@@ -150,6 +196,14 @@ def perm_rows(x, perm):
     assert x.shape[0] == perm.shape[0], f"x.shape[0] = {x.shape[0]}, perm.shape[0] = {perm.shape[0]}"
     assert perm.dim() == 2 and perm.shape[0] == perm.shape[1], f"perm.dim() = {perm.dim()}, perm.shape = {perm.shape}"
 
+    if getattr(perm, "_ccmm_is_identity", False):
+        return x
+
+    # a one-hot permutation only shuffles rows, so a gather is equivalent to the O(n^2 d) matmul
+    perm_indices = get_perm_indices_if_permutation(perm)
+    if perm_indices is not None:
+        return x.index_select(0, perm_indices)
+
     input_dims = "jklm"[: x.dim()]
     output_dims = "iklm"[: x.dim()]
 